@@ -1,15 +1,23 @@
 import streamlit as st
 import spacy
+import numpy as np
 import pandas as pd
+import pyarrow as pa
 from spacy import displacy
-from collections import Counter
+from spacy.tokens import Doc
 import altair as alt
-import json
+import xxhash
+import functools
+import hashlib
+import io
+import os
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 
 # File handling libraries
 from PyPDF2 import PdfReader
 import docx
+from docx.oxml.ns import qn
 
 # AgGrid
 from st_aggrid import AgGrid, GridOptionsBuilder, DataReturnMode, GridUpdateMode
@@ -17,22 +25,46 @@ from st_aggrid import AgGrid, GridOptionsBuilder, DataReturnMode, GridUpdateMode
 # ---------------------------
 # Helpers: text extraction
 # ---------------------------
-def extract_text_from_pdf(uploaded_file):
+# hash multi-MB uploads with SIMD-accelerated xxh3 instead of Streamlit's
+# default byte-wise hasher when computing the cache key
+_BYTES_HASH = {bytes: xxhash.xxh3_128_intdigest}
+
+@st.cache_data(show_spinner=False, hash_funcs=_BYTES_HASH)
+def extract_text_from_pdf(file_bytes):
+    """Stream page texts into one buffer; cached on the raw file bytes."""
     try:
-        reader = PdfReader(uploaded_file)
-        text = []
+        reader = PdfReader(io.BytesIO(file_bytes))
+        buf = io.StringIO()
         for page in reader.pages:
-            page_text = page.extract_text() or ""
-            text.append(page_text)
-        return "\n".join(text)
+            buf.write(page.extract_text() or "")
+            buf.write("\n")
+        return buf.getvalue()
     except Exception as e:
         return f"[PDF extraction error] {e}"
 
-def extract_text_from_docx(uploaded_file):
+@st.cache_data(show_spinner=False, hash_funcs=_BYTES_HASH)
+def extract_text_from_docx(file_bytes):
+    """Stream paragraph texts into one buffer; cached on the raw file bytes.
+
+    Walks the w:p/w:t elements of the document XML directly instead of
+    materializing python-docx Paragraph wrappers for every paragraph.
+    """
     try:
-        doc = docx.Document(uploaded_file)
-        paragraphs = [p.text for p in doc.paragraphs]
-        return "\n".join(paragraphs)
+        doc = docx.Document(io.BytesIO(file_bytes))
+        buf = io.StringIO()
+        # body-level paragraphs only, matching doc.paragraphs; tabs and
+        # soft line breaks map to \t/\n the same way Paragraph.text does
+        t_tag, tab_tag = qn("w:t"), qn("w:tab")
+        for p in doc.element.body.iterchildren(qn("w:p")):
+            for node in p.iter(t_tag, tab_tag, qn("w:br"), qn("w:cr")):
+                if node.tag == t_tag:
+                    buf.write(node.text or "")
+                elif node.tag == tab_tag:
+                    buf.write("\t")
+                else:
+                    buf.write("\n")
+            buf.write("\n")
+        return buf.getvalue()
     except Exception as e:
         return f"[DOCX extraction error] {e}"
 
@@ -48,7 +80,8 @@ if "saved_sessions" not in st.session_state:
 # Sidebar controls
 st.sidebar.header("Settings / Uploads")
 
-model_choice = st.sidebar.selectbox("spaCy model", ["en_core_web_sm", "en_core_web_trf"])
+MODEL_OPTIONS = ["en_core_web_sm", "en_core_web_trf"]
+model_choice = st.sidebar.selectbox("spaCy model", MODEL_OPTIONS)
 uploaded_file = st.sidebar.file_uploader("Upload file (TXT, PDF, DOCX)", type=["txt","pdf","docx"])
 select_all_button = st.sidebar.button("Select All Entities")
 
@@ -57,21 +90,111 @@ select_all_button = st.sidebar.button("Select All Entities")
 # ---------------------------
 @st.cache_resource(show_spinner=False)
 def load_model(name):
+    # Device preference is process-global thinc state; the preload loop
+    # below sets it per model before calling in.
     try:
-        return spacy.load(name)
+        nlp = spacy.load(name)
     except OSError:
         with st.spinner(f"Downloading {name} model..."):
             subprocess.run(["python", "-m", "spacy", "download", name])
-        return spacy.load(name)
+        nlp = spacy.load(name)
     except Exception as e:
         st.error(f"Error loading model {name}: {e}")
         return None
+    # The app only reads ent.text/start_char/end_char/label_, so keep just
+    # the components NER depends on. If a later feature needs parse or tag
+    # info, re-enable scoped via `with nlp.select_pipes(enable=...)`.
+    keep = {"tok2vec", "transformer", "ner"}
+    nlp.select_pipes(disable=[p for p in nlp.pipe_names if p not in keep])
+    return nlp
 
-nlp = load_model(model_choice)
+# Preload both models so switching the selectbox is instant; load_model is
+# @st.cache_resource, so the unselected model stays warm. The loads run
+# serially because spacy.prefer_gpu()/require_cpu() flip process-global
+# thinc state: the transformer prefers the GPU (its forward pass is ~10x
+# slower on CPU), while the small model is pinned to the CPU so its
+# parameters stay fork-safe for the multiprocess saved-session replay.
+models = {}
+for name in MODEL_OPTIONS:
+    if name.endswith("_trf"):
+        spacy.prefer_gpu()
+    else:
+        spacy.require_cpu()
+    models[name] = load_model(name)
+nlp = models[model_choice]
 if nlp is None:
     st.sidebar.error(f"Could not load spaCy model: {model_choice}")
     st.stop()
 
+# ---------------------------
+# Cached parsing
+# ---------------------------
+CHUNK_THRESHOLD = 20_000   # texts longer than this are processed in batches
+CHUNK_SIZE = 4_000         # target characters per batch
+
+def iter_chunks(text, n=CHUNK_SIZE):
+    """Yield paragraph blocks of roughly n characters each.
+
+    Paragraphs longer than n are split at the last whitespace inside the
+    limit (hard-cut if they contain none), so no chunk can ever approach
+    spaCy's nlp.max_length — one giant unbroken paragraph would otherwise
+    raise or trigger a massive single-Doc allocation.
+    """
+    buf = io.StringIO()
+    size = 0
+    for para in text.split("\n"):
+        while len(para) > n:
+            if size:
+                yield buf.getvalue()
+                buf = io.StringIO()
+                size = 0
+            cut = para.rfind(" ", 0, n) + 1 or n
+            yield para[:cut]
+            para = para[cut:]
+        if size and size + len(para) > n:
+            yield buf.getvalue()
+            buf = io.StringIO()
+            size = 0
+        buf.write(para)
+        buf.write("\n")
+        size += len(para) + 1
+    if size:
+        yield buf.getvalue()
+
+@st.cache_data(max_entries=32, show_spinner=False)
+def parse_text(text, model_name):
+    """Run the pipeline once per (text, model) pair and cache the serialized Doc.
+
+    Long texts are split into paragraph chunks and processed with nlp.pipe()
+    so spaCy can batch them; Doc.from_docs() re-indexes entity offsets back
+    into the original text. load_model already strips non-NER components.
+    """
+    nlp = load_model(model_name)
+    if len(text) > CHUNK_THRESHOLD:
+        docs = list(nlp.pipe(iter_chunks(text), batch_size=32))
+        # ensure_whitespace=False: chunks already carry their separators,
+        # so injected spaces would shift entity offsets off the original text
+        doc = Doc.from_docs(docs, ensure_whitespace=False)
+    else:
+        doc = nlp(text)
+    return doc.to_bytes()
+
+@st.cache_resource(show_spinner=False)
+def get_executor():
+    """Shared worker pool for off-main-thread rendering."""
+    return ThreadPoolExecutor(max_workers=2)
+
+@st.cache_data(show_spinner=False)
+def render_ents_html(doc_bytes, model_name, selected, color_items):
+    """Render displacy HTML once per (doc, selection, colors) combination."""
+    doc = Doc(load_model(model_name).vocab).from_bytes(doc_bytes)
+    return displacy.render(
+        doc,
+        style="ent",
+        options={"ents": list(selected), "colors": dict(color_items)},
+        jupyter=False
+    )
+
 # ---------------------------
 # Entity colors
 # ---------------------------
@@ -93,6 +216,14 @@ colors = {
 }
 entity_options = list(colors.keys())
 
+@functools.lru_cache(maxsize=64)
+def color_subset(keys):
+    """Cache the displacy color items per selection (keys: a frozenset)."""
+    return tuple(sorted((k, colors[k]) for k in keys))
+
+# below this row count the AgGrid JS roundtrip costs more than it saves
+AGGRID_MIN_ROWS = 500
+
 # ---------------------------
 # Main layout: tabs
 # ---------------------------
@@ -103,15 +234,24 @@ with tabs[0]:
     if uploaded_file:
         ext = uploaded_file.name.split('.')[-1].lower()
         if ext == "pdf":
-            text = extract_text_from_pdf(uploaded_file)
+            text = extract_text_from_pdf(uploaded_file.getvalue())
         elif ext == "docx":
-            text = extract_text_from_docx(uploaded_file)
+            text = extract_text_from_docx(uploaded_file.getvalue())
         else:
             text = uploaded_file.getvalue().decode("utf-8")
         st.text_area("Uploaded Text (preview)", value=text, height=240)
     else:
         text = st.text_area("Enter text manually", height=240)
 
+    # speculatively parse in the background so the Doc is usually ready
+    # by the time the user clicks Extract Entities; the (hash, model)
+    # key guards against stale results when the input changes
+    if text:
+        spec_key = (hashlib.blake2b(text.encode(), digest_size=16).digest(), model_choice)
+        if st.session_state.get("parse_key") != spec_key:
+            st.session_state["parse_key"] = spec_key
+            st.session_state["parse_future"] = get_executor().submit(parse_text, text, model_choice)
+
     if "selected_ents" not in st.session_state:
         st.session_state.selected_ents = entity_options.copy()
 
@@ -133,25 +273,72 @@ with tabs[0]:
 # ---------------------------
 if extract_button and text:
     with st.spinner("Extracting entities..."):
-        doc = nlp(text)
+        # short-circuit when the text and model match the previous run;
+        # restoring from session state skips even the cache-key hashing
+        # of the full text that parse_text would do
+        text_hash = hashlib.blake2b(text.encode(), digest_size=16).digest()
+        if (text_hash == st.session_state.get("last_text_hash")
+                and model_choice == st.session_state.get("last_model")):
+            doc_bytes = st.session_state["last_doc_bytes"]
+            doc = Doc(nlp.vocab).from_bytes(doc_bytes)
+        else:
+            if st.session_state.get("parse_key") == (text_hash, model_choice):
+                doc_bytes = st.session_state["parse_future"].result()
+            else:
+                doc_bytes = parse_text(text, model_choice)
+            doc = Doc(nlp.vocab).from_bytes(doc_bytes)
+            st.session_state["last_text_hash"] = text_hash
+            st.session_state["last_model"] = model_choice
+            st.session_state["last_doc_bytes"] = doc_bytes
 
-        # filter entities by selected_ents
-        filtered_ents = [ent for ent in doc.ents if ent.label_ in st.session_state.selected_ents]
+        # filter entities by selected_ents, comparing StringStore hashes
+        # (ints) instead of label strings; build the selection set once
+        # per rerun instead of scanning the list per lookup
+        selected_set = frozenset(st.session_state.selected_ents)
+        selected_hashes = frozenset(nlp.vocab.strings[l] for l in selected_set)
+        filtered_ents = [ent for ent in doc.ents if ent.label in selected_hashes]
 
+        # build the DataFrame column-wise to skip per-row tuples and
+        # pandas' row-wise dtype inference
+        n = len(filtered_ents)
+        ent_text = np.empty(n, object)
+        ent_start = np.empty(n, np.int32)
+        ent_end = np.empty(n, np.int32)
+        ent_label = np.empty(n, object)
+        for i, ent in enumerate(filtered_ents):
+            ent_text[i] = ent.text
+            ent_start[i] = ent.start_char
+            ent_end[i] = ent.end_char
+            ent_label[i] = ent.label_
         df = pd.DataFrame(
-            [(ent.text, ent.start_char, ent.end_char, ent.label_) for ent in filtered_ents],
-            columns=["Text", "Start", "End", "Label"]
+            {"Text": ent_text, "Start": ent_start, "End": ent_end, "Label": ent_label},
+            copy=False
         )
 
-        # Save session snapshot
+        # Save session snapshot: texts are deduplicated by hash so
+        # re-extracting the same text stores it only once, and the Arrow
+        # entity table replaces a per-entity list of dicts
+        text_key = hashlib.sha1(text.encode()).hexdigest()
+        st.session_state.setdefault("texts", {})[text_key] = text
         session_snapshot = {
-            "text": text,
-            "entities": df.to_dict(orient="records"),
+            "text_key": text_key,
+            "entities_ipc": pa.ipc.serialize_pandas(df).to_pybytes(),
+            "entity_count": len(filtered_ents),
             "selected_ents": st.session_state.selected_ents,
             "model": model_choice
         }
         st.session_state.saved_sessions.append(session_snapshot)
 
+        # kick off HTML generation on a worker thread so the Entities
+        # Table tab renders while displacy builds its markup
+        html_future = get_executor().submit(
+            render_ents_html,
+            doc_bytes,
+            model_choice,
+            tuple(st.session_state.selected_ents),
+            color_subset(selected_set)
+        )
+
     # ✅ Success or warning message
     if filtered_ents:
         st.success("✅ Extraction completed successfully!")
@@ -165,6 +352,11 @@ if extract_button and text:
         st.header("Entities Table (Searchable / Sortable)")
         if df.empty:
             st.info("No entities detected for the selected types.")
+        elif len(df) < AGGRID_MIN_ROWS:
+            # small tables don't need AgGrid's JS grid; st.dataframe skips
+            # the JSON roundtrip and component init entirely
+            st.dataframe(df, use_container_width=True)
+            df_filtered = df
         else:
             gb = GridOptionsBuilder.from_dataframe(df)
             gb.configure_pagination(paginationAutoPageSize=False, paginationPageSize=10)
@@ -184,26 +376,23 @@ if extract_button and text:
 
             df_filtered = pd.DataFrame(grid_response["data"])
 
-            if not df_filtered.empty:
-                csv = df_filtered.to_csv(index=False).encode("utf-8")
-                st.download_button("Download CSV (current view)", csv, "entities_view.csv", "text/csv")
-                st.download_button(
-                    "Download JSON (current view)",
-                    json.dumps(df_filtered.to_dict(orient="records")),
-                    "entities_view.json",
-                    "application/json"
-                )
+        if not df.empty and not df_filtered.empty:
+            csv = df_filtered.to_csv(index=False).encode("utf-8")
+            st.download_button("Download CSV (current view)", csv, "entities_view.csv", "text/csv")
+            st.download_button(
+                "Download JSON (current view)",
+                df_filtered.to_json(orient="records"),
+                "entities_view.json",
+                "application/json"
+            )
 
     # ---------------------------
     # Visualization
     # ---------------------------
     with tabs[2]:
         st.header("Entity Visualization")
-        options_displacy = {
-            "ents": st.session_state.selected_ents,
-            "colors": {k: v for k, v in colors.items() if k in st.session_state.selected_ents}
-        }
-        html = displacy.render(doc, style="ent", options=options_displacy, jupyter=False)
+        with st.spinner("Rendering entities..."):
+            html = html_future.result()
         height = max(300, len(filtered_ents) * 50)
         st.components.v1.html(html, height=height, scrolling=True)
         st.download_button("Download highlighted HTML", html, "highlighted_entities.html", "text/html")
@@ -214,15 +403,23 @@ if extract_button and text:
     with tabs[3]:
         st.header("Entity Statistics")
         if filtered_ents:
-            entity_counts = Counter([ent.label_ for ent in filtered_ents])
-            df_counts = pd.DataFrame(entity_counts.items(), columns=["Entity Type", "Count"])
+            # count label hashes at C level instead of hashing label
+            # strings through a Counter
+            label_hashes = np.fromiter(
+                (ent.label for ent in filtered_ents), np.uint64, len(filtered_ents)
+            )
+            unique_hashes, counts = np.unique(label_hashes, return_counts=True)
+            df_counts = pd.DataFrame({
+                "Entity Type": [nlp.vocab.strings[int(h)] for h in unique_hashes],
+                "Count": counts
+            })
             chart = alt.Chart(df_counts).mark_bar().encode(
                 x="Entity Type",
                 y="Count",
                 color="Entity Type"
             ).properties(width=700)
             st.altair_chart(chart)
-            st.table(df_counts.sort_values("Count", ascending=False).reset_index(drop=True))
+            st.table(df_counts.iloc[counts.argsort()[::-1]].reset_index(drop=True))
         else:
             st.write("No entities to display statistics for.")
 
@@ -232,13 +429,61 @@ if extract_button and text:
 with tabs[4]:
     st.header("Saved Sessions (this run)")
     if st.session_state.saved_sessions:
+        if st.button("Reprocess all saved sessions"):
+            texts = {
+                snap["text_key"]: st.session_state["texts"][snap["text_key"]]
+                for snap in st.session_state.saved_sessions
+                if snap.get("text_key") in st.session_state.get("texts", {})
+            }
+            # chunk each text the same way parse_text does, so a saved text
+            # longer than nlp.max_length can't make the batch raise, then
+            # fan the chunks out across processes; multiprocessing only
+            # pays off for several texts, and the trf model stays
+            # single-process to avoid GPU contention
+            chunk_lists = {
+                key: (list(iter_chunks(t)) if len(t) > CHUNK_THRESHOLD else [t])
+                for key, t in texts.items()
+            }
+            if model_choice.endswith("_trf") or len(texts) < 2:
+                n_proc = 1
+            else:
+                n_proc = max(1, os.cpu_count() // 2)
+            with st.spinner(f"Reprocessing {len(texts)} saved text(s)..."):
+                piped = nlp.pipe(
+                    (c for chunks in chunk_lists.values() for c in chunks),
+                    n_process=n_proc, batch_size=16
+                )
+                docs_by_key = {}
+                for key, chunks in chunk_lists.items():
+                    docs = [next(piped) for _ in chunks]
+                    docs_by_key[key] = (
+                        docs[0] if len(docs) == 1
+                        else Doc.from_docs(docs, ensure_whitespace=False)
+                    )
+            for snap in st.session_state.saved_sessions:
+                snap_doc = docs_by_key.get(snap.get("text_key"))
+                if snap_doc is not None:
+                    # keep the count consistent with the snapshot's own
+                    # entity-type selection
+                    sel = frozenset(
+                        nlp.vocab.strings[l]
+                        for l in snap.get("selected_ents", entity_options)
+                    )
+                    snap["entity_count"] = sum(ent.label in sel for ent in snap_doc.ents)
+                    snap["model"] = model_choice
+                    snap.pop("entities_ipc", None)
+            st.success(f"Reprocessed {len(texts)} unique text(s) with {model_choice}.")
+
         for i, snap in enumerate(st.session_state.saved_sessions[::-1], 1):
             st.subheader(f"Session #{i}")
             st.write("Model:", snap.get("model"))
             st.write("Selected entity types:", snap.get("selected_ents"))
-            st.write("Entities count:", len(snap.get("entities", [])))
+            st.write("Entities count:", snap.get("entity_count", 0))
             if st.button(f"Load session #{i}", key=f"load_{i}"):
                 st.session_state.selected_ents = snap.get("selected_ents", entity_options)
-                st.text_area("Loaded session text (read-only)", value=snap.get("text",""), height=200)
+                snap_text = st.session_state.get("texts", {}).get(snap.get("text_key"), "")
+                st.text_area("Loaded session text (read-only)", value=snap_text, height=200)
+                if "entities_ipc" in snap:
+                    st.dataframe(pa.ipc.deserialize_pandas(snap["entities_ipc"]))
     else:
         st.write("No saved sessions yet. Click 'Extract Entities' to create snapshots.")